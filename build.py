@@ -1,13 +1,23 @@
 import argparse
 import logging
+import os
+import random
 import shutil
 import sys
+import threading
+import time
 from datetime import datetime
 from pathlib import Path
 import requests
 from requests.adapters import HTTPAdapter
+from urllib3.exceptions import HTTPError as Urllib3HTTPError
 from urllib3.util import Retry
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+
+try:
+    import orjson  # Optional: a much faster C parser for the multi-MB search index.
+except ImportError:
+    orjson = None
 
 __version__ = '1.0.0'
 
@@ -16,6 +26,10 @@ def get_version():
 
 logging.basicConfig(level=logging.INFO, format=' %(message)s')
 
+# Number of concurrent download workers; the session's connection pool is sized to match
+# so every worker keeps a persistent connection instead of re-doing TCP/TLS handshakes.
+MAX_WORKERS = 20
+
 class CustomArgumentParser(argparse.ArgumentParser):
     def error(self, message):
         logging.error(message)
@@ -43,17 +57,17 @@ def create_dockerfile(base_dir):
     logging.info(f"Dockerfile created at {dockerfile_path}")
 
 def copy_and_modify_readme(base_dir, kibana_version):
-    """Copy the 'instructions.md' file from the support directory, rename it to 'readme.md', and modify its contents."""
+    """Render the 'instructions.md' template from the support directory as 'readme.md'."""
     source_path = Path(__file__).parent / 'support' / 'instructions.md'
     destination_path = base_dir / 'readme.md'
-    shutil.copy(source_path, destination_path)
+    template = source_path.read_bytes()
+    destination_path.write_bytes(template.replace(b'{version}', kibana_version.encode()))
     logging.info(f"Created 'readme.md' at {destination_path}")
-    with open(destination_path, 'r+') as file:
-        content = file.read()
-        modified_content = content.replace('{version}', kibana_version)
-        file.seek(0)
-        file.write(modified_content)
-        file.truncate()
+
+def create_build_scaffolding(base_dir, kibana_version):
+    """Write the Dockerfile and readme for a build directory."""
+    create_dockerfile(base_dir)
+    copy_and_modify_readme(base_dir, kibana_version)
 
 def create_builds_directory(kibana_version):
     """Create a timestamped builds directory based on the Kibana version."""
@@ -64,89 +78,257 @@ def create_builds_directory(kibana_version):
     (base_dir / 'integrations').mkdir(exist_ok=True)
     return base_dir, base_dir / 'integrations'
 
-def setup_download_session():
-    """Set up a requests session with retry logic."""
-    retry_strategy = Retry(
+def create_cache_directory(kibana_version):
+    """Create (or reuse) the stable download cache for a Kibana version, shared across runs."""
+    cache_dir = Path(__file__).parent / 'builds' / 'cache' / kibana_version
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    return cache_dir
+
+def setup_download_session(pool_maxsize=MAX_WORKERS):
+    """Set up a requests session with retry logic and a connection pool sized for the workers."""
+    retry_options = dict(
         total=5,  # Total number of retries to allow.
-        backoff_factor=1,  # A backoff factor to apply between attempts after the second try.
-        status_forcelist=(500, 502, 504),  # A set of HTTP status codes that we should force a retry on.
-        method_whitelist=["HEAD", "GET", "OPTIONS"]  # Optional: set methods to retry
+        backoff_factor=0.5,  # Exponential backoff: 0.5, 1, 2, 4, 8 seconds between attempts.
+        status_forcelist=(408, 429, 500, 502, 503, 504),  # A set of HTTP status codes that we should force a retry on.
+        allowed_methods=frozenset(["HEAD", "GET", "OPTIONS"]),  # Only retry idempotent methods.
+        respect_retry_after_header=True,  # Honor Retry-After on 429/503 responses.
+    )
+    try:
+        # backoff_jitter (urllib3 >= 2.0) randomizes delays so parallel workers
+        # don't all retry at the same instant after a server-side error.
+        retry_strategy = Retry(backoff_jitter=0.5, **retry_options)
+    except TypeError:
+        retry_strategy = Retry(**retry_options)
+    adapter = HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=pool_maxsize,
+        pool_block=True,  # Make workers wait for a pooled connection instead of opening throwaway sockets.
+        max_retries=retry_strategy,
     )
-    adapter = HTTPAdapter(max_retries=retry_strategy)
     session = requests.Session()
     session.mount('https://', adapter)
     session.mount('http://', adapter)
     return session
 
-def fetch_and_count_files(kibana_version):
-    """Fetch the list of packages and count the total files to download based on the Kibana version."""
+def fetch_packages(session, kibana_version):
+    """Fetch the list of packages available for the given Kibana version from the EPR search API."""
     url = f"https://epr.elastic.co/search?kibana.version={kibana_version}"
-    session = setup_download_session()
     response = session.get(url)
     response.raise_for_status()
-    packages = response.json()
-    
-    # Assuming each package has one main file and one signature file
-    total_files = 2 * len(packages)
-    return total_files
+    if orjson is not None:
+        return orjson.loads(response.content)
+    return response.json()
 
 
-def download_file(session, url, path):
-    """Download a file from a URL to a specified path with a session that has retry logic."""
+def download_file(session, url, path, attempts=3):
+    """Download a file from a URL to a specified path with a session that has retry logic.
+
+    Data is streamed into a '.partial' staging file that is only renamed to the
+    final name once the size check against the advertised Content-Length passes,
+    so a truncated transfer is reported rather than counted as done. If a staging
+    file is left over from an interrupted run, ask the server to resume from its
+    current size with a Range request. A 206 response is appended to the staging
+    file; a 200 response means the server ignored the range, so it is rewritten
+    from scratch.
+
+    If the session's own retries are exhausted (e.g. the registry keeps answering
+    429), back off with decorrelated jitter and try the whole request again, up to
+    `attempts` times.
+    """
+    for attempt in range(attempts):
+        if attempt:
+            # Randomized exponential delay so rate-limited workers don't all
+            # come back at the same instant (Retry-After, when the server sends
+            # one, is already honored inside the session's retry strategy).
+            delay = min(30, 2 ** attempt) * (1 + random.random())
+            logging.warning(f"Retrying {url} in {delay:.1f}s (attempt {attempt + 1} of {attempts})")
+            time.sleep(delay)
+        result = _download_once(session, url, path)
+        if result is not _RETRYABLE:
+            return result
+    logging.error(f"Giving up on {url} after {attempts} attempts")
+    return None
+
+
+# Sentinel returned by _download_once when the failure is worth another attempt.
+_RETRYABLE = object()
+
+
+def _content_range_total(response):
+    """Extract the total size from a 416 response's 'Content-Range: bytes */<total>' header."""
+    total = response.headers.get('Content-Range', '').rpartition('/')[2]
+    return int(total) if total.isdigit() else None
+
+
+def _download_once(session, url, path):
+    """Perform a single (resumable, streamed) download attempt for download_file."""
+    # Completed cache entries are hard-linked into build directories, so the
+    # final name must never be opened for writing again — rewriting it (e.g.
+    # when the server ignores the Range header and answers 200) would mutate
+    # every older build sharing the inode. All writes go to the staging file.
+    partial_path = path.with_name(path.name + '.partial')
     try:
-        response = session.get(url)
-        response.raise_for_status()
-        with path.open('wb') as file:
-            file.write(response.content)
+        if path.exists():
+            # Renamed into place by a previous run after passing its size check.
+            return path
+        existing_size = partial_path.stat().st_size if partial_path.exists() else 0
+        headers = {'Range': f'bytes={existing_size}-'} if existing_size else {}
+        with session.get(url, stream=True, timeout=(5, 60), headers=headers) as response:
+            if response.status_code == 416:
+                # The requested range starts past the end of the file. That only
+                # proves the staging file is big enough; accept it solely when it
+                # matches the total the server reports in Content-Range, otherwise
+                # (e.g. an oversized leftover from interleaved runs) discard it
+                # and fetch the file again from scratch.
+                total_size = _content_range_total(response)
+                if total_size is not None and existing_size == total_size:
+                    os.replace(partial_path, path)
+                    return path
+                logging.warning(
+                    f"Discarding invalid cached partial for {url}: "
+                    f"{existing_size} bytes vs server total {total_size}"
+                )
+                partial_path.unlink(missing_ok=True)
+                return _RETRYABLE
+            response.raise_for_status()
+            # Leave decode_content off: the packages are .zip/.sig files that are
+            # never transfer-compressed, and writing decoded bytes would break
+            # both the Content-Length size check and raw-byte Range resume.
+            resumed = response.status_code == 206
+            content_length = int(response.headers.get('Content-Length', 0))
+            expected_size = existing_size + content_length if resumed else content_length
+            # Reuse one 64KB buffer for the whole transfer: readinto fills it in
+            # place and the memoryview slice is written without copying, instead
+            # of allocating a fresh bytes object per chunk.
+            buffer = bytearray(65536)
+            view = memoryview(buffer)
+            written = 0
+            with partial_path.open('ab' if resumed else 'wb') as file:
+                # Preallocation extends st_size to the full expected size, so only
+                # do it for fresh writes: in append mode the O_APPEND writes would
+                # land at the extended EOF, leaving a zero gap after the partial.
+                if content_length and not resumed and hasattr(os, 'posix_fallocate'):
+                    try:
+                        # Reserve the file's full extent up front so concurrent
+                        # workers growing files 64KB at a time don't fragment
+                        # each other's allocations.
+                        os.posix_fallocate(file.fileno(), 0, content_length)
+                    except OSError:
+                        pass  # Filesystem doesn't support preallocation; write as usual.
+                try:
+                    while True:
+                        read = response.raw.readinto(buffer)
+                        if not read:
+                            break
+                        file.write(view[:read])
+                        written += read
+                finally:
+                    if not resumed:
+                        # Trim the preallocated tail, even when the transfer is cut
+                        # short: zero padding up to the full size would hide the
+                        # truncation from the size check and make the next run's
+                        # Range request come back 416 on a corrupt cached file.
+                        file.truncate(written)
+        received_size = existing_size + written if resumed else written
+        if expected_size and received_size != expected_size:
+            # Keep the staging file so the next attempt can resume from it.
+            logging.error(
+                f"Size mismatch for {url}: got {received_size} bytes, expected {expected_size}"
+            )
+            return _RETRYABLE
+        os.replace(partial_path, path)
         return path
+    except requests.exceptions.RetryError:
+        # The session's urllib3 retries ran out, typically on persistent 429/503.
+        return _RETRYABLE
     except requests.RequestException as e:
         logging.error(f"Failed to download {url}: {e}")
         return None
+    except (Urllib3HTTPError, OSError) as e:
+        # readinto bypasses requests' exception wrapping, so a connection dropped
+        # mid-body surfaces as a raw urllib3 or socket error. A resumable partial
+        # is on disk, so let the backoff loop pick it up with a Range request.
+        logging.warning(f"Transfer interrupted for {url}: {e}")
+        return _RETRYABLE
     
-def verify_downloaded_files(integrations_dir, expected_files):
-    """Verify that all expected files have been downloaded."""
-    downloaded_files = set(file.name for file in integrations_dir.iterdir())
-    missing_files = [file.name for file in expected_files if file.name not in downloaded_files]
-    
+def verify_downloaded_files(expected_files, downloaded_files):
+    """Verify that every expected file was downloaded and passed its size check."""
+    missing_files = [file.name for file in expected_files if file not in downloaded_files]
+
     if missing_files:
         logging.warning(f"Missing files: {missing_files}")
     else:
         logging.info("All files have been successfully downloaded and verified.")
 
-def fetch_and_download_files(kibana_version, integrations_dir, total_files):
-    """Fetch and download files based on the Kibana version, logging the total files count."""
-    url = f"https://epr.elastic.co/search?kibana.version={kibana_version}"
-    session = setup_download_session()
-    response = session.get(url)
-    response.raise_for_status()
-    packages = response.json()
-    
+def iter_download_tasks(packages, cache_dir):
+    """Yield (url, cache path) pairs for each package's main file and signature file."""
+    base_url = "https://epr.elastic.co"
+    for pkg in packages:
+        for url_path in (pkg['download'], pkg['signature_path']):
+            # The EPR paths are always '/epr/<package>/<file>'; rpartition gets the
+            # basename without parsing the whole path into a PurePath first.
+            yield base_url + url_path, cache_dir / url_path.rpartition('/')[2]
+
+
+def link_into_build(cache_path, destination):
+    """Hard-link a cached file into the build directory, copying if linking isn't possible."""
+    try:
+        os.link(cache_path, destination)
+    except FileExistsError:
+        pass
+    except OSError:
+        # e.g. the builds directory spans filesystems; fall back to a real copy.
+        shutil.copy2(cache_path, destination)
+
+
+def fetch_and_download_files(session, packages, integrations_dir, cache_dir, total_files):
+    """Download each package's files into the version cache and hard-link them into the build.
+
+    Files already complete in the cache from a previous run are skipped (the ranged
+    request in download_file comes back 416), so re-runs only fetch what's missing.
+    """
     downloaded_count = 0
     expected_files = []
-    with ThreadPoolExecutor(max_workers=10) as executor:
-        future_to_file = {}
-        for pkg in packages:
-            base_url = "https://epr.elastic.co"
-            file_path = integrations_dir / Path(pkg['download']).name
-            signature_path = integrations_dir / Path(pkg['signature_path']).name
-            
-            expected_files.append(file_path)
-            expected_files.append(signature_path)
-
-            future_to_file[executor.submit(download_file, session, base_url + pkg['download'], file_path)] = file_path
-            future_to_file[executor.submit(download_file, session, base_url + pkg['signature_path'], signature_path)] = signature_path
-
-        for future in as_completed(future_to_file):
-            path = future_to_file[future]
+    downloaded_files = set()
+    # Keep the number of queued downloads bounded so memory stays O(workers)
+    # instead of O(packages) when the index lists thousands of files.
+    max_in_flight = 2 * MAX_WORKERS
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        in_flight = {}
+        last_repaint = 0.0
+
+        def handle_completed(future):
+            nonlocal downloaded_count, last_repaint
+            path = in_flight.pop(future)
             try:
                 result = future.result()
                 if result:
+                    link_into_build(result, integrations_dir / result.name)
+                    downloaded_files.add(result)
                     downloaded_count += 1
-                    logging.info(f"Downloaded: ({downloaded_count} of {total_files}) {path.name}")
+                    # Repaint a single progress line at most a few times per second
+                    # rather than emitting one log line per completed file.
+                    now = time.monotonic()
+                    if now - last_repaint >= 0.2 or downloaded_count == total_files:
+                        print(f"\rDownloaded {downloaded_count} of {total_files} files", end='', flush=True)
+                        last_repaint = now
             except Exception as e:
                 logging.error(f"File download failed for {path.name}: {e}")
 
-    verify_downloaded_files(integrations_dir, expected_files)
+        for url, path in iter_download_tasks(packages, cache_dir):
+            expected_files.append(path)
+            if len(in_flight) >= max_in_flight:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    handle_completed(future)
+            in_flight[executor.submit(download_file, session, url, path)] = path
+
+        for future in as_completed(list(in_flight)):
+            handle_completed(future)
+
+    if downloaded_count:
+        print()  # End the progress line before any further log output.
+    verify_downloaded_files(expected_files, downloaded_files)
 
 
 def main():
@@ -155,14 +337,21 @@ def main():
     logging.info(f"Starting the script with Kibana version: {kibana_version}")
     
     base_dir, integrations_dir = create_builds_directory(kibana_version)
-    total_files = fetch_and_count_files(kibana_version)  # Ensure this function is defined
+    cache_dir = create_cache_directory(kibana_version)
+    session = setup_download_session()
+    packages = fetch_packages(session, kibana_version)
+    # Each package has one main file and one signature file.
+    total_files = 2 * len(packages)
     logging.info(f"Total files to download: {total_files}")
     logging.info(".............................................................")
-    
-    fetch_and_download_files(kibana_version, integrations_dir, total_files)
-    create_dockerfile(base_dir)
-    copy_and_modify_readme(base_dir, kibana_version)
-    
+
+    # The Dockerfile and readme only depend on the build directory, so write them
+    # while the downloads run; they also no longer hinge on the downloads succeeding.
+    scaffolding = threading.Thread(target=create_build_scaffolding, args=(base_dir, kibana_version))
+    scaffolding.start()
+    fetch_and_download_files(session, packages, integrations_dir, cache_dir, total_files)
+    scaffolding.join()
+
     # Display a fancy ending message with the location of the readme.md
     readme_location = base_dir / 'readme.md'
     print("\n" + "*" * 40)